@@ -32,14 +32,35 @@ Main code for enpassreaderlib.
 """
 
 import binascii
+import functools
 import hashlib
+import hmac
 import logging
+import os
+import re
+import struct
+import time
 
 from pathlib import Path
 
 from Crypto.Cipher import AES
 from pysqlcipher3 import dbapi2 as sqlite
 
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:
+    AESGCM = PBKDF2HMAC = None
+    # pycryptodome raises ValueError when the authentication fails
+    InvalidTag = ValueError
+
+try:
+    from fastpbkdf2 import pbkdf2_hmac as fast_pbkdf2_hmac
+except ImportError:
+    fast_pbkdf2_hmac = None
+
 from .enpassreaderlibexceptions import EnpassDatabaseError
 
 __author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
@@ -58,22 +79,130 @@ LOGGER_BASENAME = 'enpassreaderlib'
 LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
+# The location and lifetime of the optional cache of the derived database keys, the location
+# defaults to ~/.cache/enpassreaderlib and is only resolved when caching is enabled.
+# The cache secret is rotated after the lifetime so it invalidates all the cached keys as well.
+DERIVED_KEY_CACHE_PATH = None
+DERIVED_KEY_CACHE_LOCAL_KEY_FILENAME = 'local.key'
+DERIVED_KEY_CACHE_TTL = 3600
+
+# The key file is an xml document holding the hex encoded key in a <key> element,
+# only whole bytes are matched so an odd number of hex digits is not a valid key
+KEY_FILE_REGEX = re.compile(rb'<key>\s*((?:[0-9a-fA-F]{2})+)\s*</key>')
+
+
+def _encrypt(key, nonce, plaintext, header):
+    # The value returned holds the ciphertext followed by the 16 bytes authentication tag,
+    # the same layout enpass uses and _decrypt expects.
+    if AESGCM is not None:
+        return AESGCM(key).encrypt(nonce, plaintext, header)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return ciphertext + tag
+
+
+def _decrypt(key, nonce, value, header):
+    # The value holds the ciphertext followed by the 16 bytes authentication tag.
+    # cryptography's AESGCM is preferred since its per call overhead is much lower.
+    if AESGCM is not None:
+        return AESGCM(key).decrypt(nonce, value, header)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    return cipher.decrypt_and_verify(value[:-16], value[-16:])
+
+
+def _is_expired(path):
+    return time.time() - path.stat().st_mtime > DERIVED_KEY_CACHE_TTL
+
+
+def _write_private_file(path, content):
+    # Written to a temporary file first so readers never see a partially written file
+    temporary_path = Path(f'{path}.{os.getpid()}.tmp')
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+    with os.fdopen(descriptor, 'wb') as private_file:
+        private_file.write(content)
+    os.replace(temporary_path, path)
+
+
+def _get_cache_path():
+    if DERIVED_KEY_CACHE_PATH is not None:
+        return Path(DERIVED_KEY_CACHE_PATH)
+    return Path.home() / '.cache' / 'enpassreaderlib'
+
+
+def _get_cache_secret(cache_path):
+    secret_file = Path(cache_path, DERIVED_KEY_CACHE_LOCAL_KEY_FILENAME)
+    try:
+        if _is_expired(secret_file):
+            return None
+        return secret_file.read_bytes()
+    except OSError:
+        return None
+
+
+def _rotate_cache_secret(cache_path):
+    cache_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(cache_path, 0o700)
+    secret = os.urandom(32)
+    _write_private_file(Path(cache_path, DERIVED_KEY_CACHE_LOCAL_KEY_FILENAME), secret)
+    return secret
+
+
+def _sweep_cached_keys(cache_path, remove_all=False):
+    for cache_file in cache_path.glob('*.bin'):
+        try:
+            if remove_all or _is_expired(cache_file):
+                cache_file.unlink()
+        except OSError:
+            LOGGER.warning(f'Could not remove expired cached key {cache_file}.')
+
 
 class EnpassDB:
-    """Manages the database object exposing useful methods to interact with it."""
+    """Manages the database object exposing useful methods to interact with it.
+
+    Attributes:
+        master_password (bytes): The master password calculated along with the key if provided else the password
+            provided, used to decrypt the database.
+        pbkdf2_rounds (int): The iterations of PBKDF2-HMAC-SHA512 used to derive the key of the database.
 
-    def __init__(self, database_path, password, keyfile=None, pbkdf2_rounds=320_000):
+    """
+
+    def __init__(self, database_path, password, keyfile=None, pbkdf2_rounds=320_000, cache_derived_key=False):
         self._database_path = database_path
-        self._password = password.encode('utf-8')
-        self._keyfile = keyfile
+        self.master_password = password.encode('utf-8')
+        if keyfile:
+            key_hex_xml = Path(keyfile).read_bytes()
+            match = KEY_FILE_REGEX.search(key_hex_xml)
+            if not match:
+                raise EnpassDatabaseError(f'The key file provided :{keyfile} is not a valid enpass key file.')
+            self.master_password += binascii.unhexlify(match.group(1))
         self.pbkdf2_rounds = pbkdf2_rounds
-        self._master_password = None
-        self._cipher_key = None
-        self._connection, self._cursor = self._authenticate()
-
-    @property
-    def _retrieve_all_query(self):
+        self._cache_path = None
+        if cache_derived_key:
+            try:
+                self._cache_path = _get_cache_path()
+            except (RuntimeError, KeyError):
+                LOGGER.warning('Could not determine the home directory, the derived key will not be cached.')
+        self._retrieve_all_query = self._get_retrieve_all_query()
+        self._all_entries_query = f'{self._retrieve_all_query};'
+        self._get_entry_query = f'{self._retrieve_all_query} AND lower(i.title) = ?;'
+        self._search_entries_query = f'{self._retrieve_all_query} AND lower(i.title) LIKE ?;'
+        enpass_db_salt, enpass_db_key, is_cached = self._get_database_key()
+        # The raw key for the sqlcipher database is given by the first
+        # 32 bytes of the key, hex-encoded to 64 characters
+        cipher_key = enpass_db_key[:32].hex()
+        self._connection = self._authenticate(cipher_key)
+        self._cipher_key = cipher_key
+        # The key is only cached after it has been validated against the database
+        if self._cache_path and not is_cached:
+            self._set_cached_key(enpass_db_salt, enpass_db_key)
+
+    @staticmethod
+    def _get_retrieve_all_query():
         field_types = ['password', 'totp']
+        # If you deleted an item from Enpass, it stays in the database, but the
+        # entries are cleared so only entries with nonce are valid entries
         return ('SELECT '
                 'i.title, '
                 'i.uuid, '
@@ -85,23 +214,8 @@ class EnpassDB:
                 'FROM item i ' + ''.join([(f'LEFT JOIN '
                                            f'(SELECT item_uuid, type, value, hash '
                                            f'FROM itemfield WHERE type = "{type_}") if_{type_} '
-                                           f'ON i.uuid = if_{type_}.item_uuid ') for type_ in field_types]))
-
-    @property
-    def master_password(self):
-        """The master password calculated along with the key if provided else the password provided.
-
-        Returns:
-            master_password (bytearray): The master password to decrypt the database.
-
-        """
-        if self._master_password is None:
-            if self._keyfile:
-                key_hex_xml = Path(self._keyfile).read_bytes()
-                key_bytes = binascii.unhexlify(key_hex_xml[slice(5, -6)])  # noqa
-                self._password = self._password + key_bytes
-            self._master_password = self._password
-        return self._master_password
+                                           f'ON i.uuid = if_{type_}.item_uuid ') for type_ in field_types]) +
+                'WHERE length(i.key) > 32')
 
     @property
     def cipher_key(self):
@@ -111,38 +225,98 @@ class EnpassDB:
             cipher_key (string): The cipher key to decrypt the database entries.
 
         """
-        if self._cipher_key is None:
-            # The first 16 bytes of the database file are used as salt
-            with open(self._database_path, "rb") as db:
-                enpass_db_salt = db.read(16)
-            # The database key is derived from the master password
-            # and the database salt with 100k iterations of PBKDF2-HMAC-SHA512
-            enpass_db_key = hashlib.pbkdf2_hmac("sha512", self.master_password, enpass_db_salt, self.pbkdf2_rounds)
-            # The raw key for the sqlcipher database is given
-            # by the first 64 characters of the hex-encoded key
-            self._cipher_key = enpass_db_key.hex()[:64]
         return self._cipher_key
 
-    def _authenticate(self):
+    def _get_database_key(self):
+        # The first 16 bytes of the database file are used as salt
+        # A raw descriptor is enough to read them, O_BINARY only exists on windows
+        descriptor = os.open(self._database_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            enpass_db_salt = os.read(descriptor, 16)
+        finally:
+            os.close(descriptor)
+        enpass_db_key = self._get_cached_key(enpass_db_salt) if self._cache_path else None
+        if enpass_db_key is not None:
+            return enpass_db_salt, enpass_db_key, True
+        return enpass_db_salt, self._derive_key(enpass_db_salt), False
+
+    def _derive_key(self, salt):
+        # The database key is derived from the master password and the
+        # database salt with pbkdf2_rounds iterations of PBKDF2-HMAC-SHA512.
+        # fastpbkdf2 and then OpenSSL's implementation through cryptography are preferred
+        # if available since they are usually faster than the one hashlib is built with.
+        if fast_pbkdf2_hmac is not None:
+            LOGGER.debug('Deriving the database key with fastpbkdf2.')
+            return fast_pbkdf2_hmac("sha512", self.master_password, salt, self.pbkdf2_rounds, 64)
+        if PBKDF2HMAC is not None:
+            LOGGER.debug('Deriving the database key with cryptography.')
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA512(), length=64, salt=salt, iterations=self.pbkdf2_rounds)
+            return kdf.derive(self.master_password)
+        LOGGER.debug('Deriving the database key with hashlib.')
+        return hashlib.pbkdf2_hmac("sha512", self.master_password, salt, self.pbkdf2_rounds)
+
+    def _get_cache_digest(self, secret, purpose, salt):
+        # Everything stored in the cache depends on the random local secret, so nothing
+        # in it can be used to verify password guesses without it. Every field is length
+        # prefixed so different combinations of them can never produce the same message.
+        fields = (purpose, salt, struct.pack('>Q', self.pbkdf2_rounds), self.master_password)
+        message = b''.join(struct.pack('>I', len(field)) + field for field in fields)
+        return hmac.new(secret, message, hashlib.sha256).digest()
+
+    def _get_cache_file(self, secret, salt):
+        cache_id = self._get_cache_digest(secret, b'name', salt).hex()
+        return Path(self._cache_path, f'{cache_id}.bin')
+
+    def _get_cached_key(self, salt):
+        secret = _get_cache_secret(self._cache_path)
+        if secret is None:
+            return None
+        cache_file = self._get_cache_file(secret, salt)
+        try:
+            if _is_expired(cache_file):
+                cache_file.unlink()
+                return None
+            cached_value = cache_file.read_bytes()
+            return _decrypt(self._get_cache_digest(secret, b'key', salt), cached_value[:12], cached_value[12:], b'')
+        except (OSError, InvalidTag, ValueError):
+            return None
+
+    def _set_cached_key(self, salt, key):
+        try:
+            secret = _get_cache_secret(self._cache_path)
+            if secret is None:
+                # A new secret makes all the keys cached with the previous one unusable
+                _sweep_cached_keys(self._cache_path, remove_all=True)
+                secret = _rotate_cache_secret(self._cache_path)
+            else:
+                _sweep_cached_keys(self._cache_path)
+            nonce = os.urandom(12)
+            value = _encrypt(self._get_cache_digest(secret, b'key', salt), nonce, key, b'')
+            _write_private_file(self._get_cache_file(secret, salt), nonce + value)
+        except OSError:
+            LOGGER.warning(f'Could not cache the derived key under {self._cache_path}.')
+
+    def _authenticate(self, cipher_key):
         try:
             connection = sqlite.connect(self._database_path)
+            connection.row_factory = sqlite.Row
             cursor = connection.cursor()
-            cursor.row_factory = sqlite.Row
-            cursor.execute(f"PRAGMA key=\"x'{self.cipher_key}'\";")
-            cursor.execute('PRAGMA cipher_compatibility = 3;')
-            cursor.execute('SELECT * FROM Identity;').fetchone()
+            # A bigger page cache keeps the decrypted pages around across queries
+            cursor.executescript(f"PRAGMA key=\"x'{cipher_key}'\";"
+                                 'PRAGMA cipher_compatibility = 3;'
+                                 'PRAGMA cache_size = -65536;')
+            # Reading from any table validates the key without decrypting a full row
+            cursor.execute('SELECT 1 FROM Identity LIMIT 1;').fetchone()
         except sqlite.DatabaseError:
             raise EnpassDatabaseError('Either the master password or the key file provided cannot decrypt '
                                       'the database, or it is not a valid enpass 6 encrypted database,'
                                       'or the pbkdf2_rounds is not correct. '
                                       f'The pbkdf2_rounds currently set is {self.pbkdf2_rounds}') from None
-        return connection, cursor
+        return connection
 
-    def _query(self, query):
-        self._cursor.execute(query)
-        # If you deleted an item from Enpass, it stays in the database, but the
-        # entries are cleared so only entries with nonce are valid entries
-        return [row for row in self._cursor if row["key"][32:]]
+    def _query(self, query, parameters=()):
+        # A cursor per query so rows can be streamed without interfering with other queries
+        yield from self._connection.execute(query, parameters)
 
     @property
     def entries(self):
@@ -152,7 +326,28 @@ class EnpassDB:
             entries (list): The password entries in the database.
 
         """
-        return [Entry(row) for row in self._query(f'{self._retrieve_all_query};')]
+        return list(self.iter_entries())
+
+    def iter_entries(self):
+        """Iterates over all the entries in the database without loading them all in memory.
+
+        Returns:
+            entries (generator): A generator of the password entries in the database.
+
+        """
+        return (Entry(row) for row in self._query(self._all_entries_query))
+
+    def decrypt_all(self):
+        """All the entries in the database with their passwords decrypted in a single pass.
+
+        Returns:
+            entries (list): The password entries in the database with their passwords already decrypted.
+
+        """
+        entries = self.entries
+        for entry in entries:
+            _ = entry.password
+        return entries
 
     def get_entry(self, name):
         """Retrieves a single entry matching the name.
@@ -164,8 +359,7 @@ class EnpassDB:
             entry (Entry): A password entry object if match found else None.
 
         """
-        query = f'{self._retrieve_all_query} WHERE lower(i.title) = \"{name.lower()}\";'
-        row = next((row for row in self._query(query)),
+        row = next((row for row in self._query(self._get_entry_query, (name.lower(),))),
                    None)
         if row is None:
             return row
@@ -181,8 +375,7 @@ class EnpassDB:
             entries (list): A list of password entries matching the fuzzy search for the given name.
 
         """
-        query = f'{self._retrieve_all_query} WHERE lower(i.title) LIKE \"%{name.lower()}%\";'
-        return [Entry(row) for row in self._query(query)]
+        return [Entry(row) for row in self._query(self._search_entries_query, (f'%{name.lower()}%',))]
 
 
 class Entry:
@@ -194,37 +387,38 @@ class Entry:
         self.key = database_row["key"][:32]
         self.nonce = database_row["key"][32:]
         self.title = database_row["title"]
-        self._password_value = database_row["password_value"]
+        # The value object holds the ciphertext (same length as plaintext) +
+        # (authentication) tag (16 bytes) and is stored in hex so it is decoded once
+        password_value = database_row["password_value"]
+        self._ct_and_tag = bytes.fromhex(password_value) if password_value else None
         self._password_hash = database_row["password_value_hash"]
         self.uuid = database_row["uuid"]
         self._totp_hash = database_row["totp_value_hash"]
         self._totp = database_row["totp_value"]
         self.header = self.uuid.replace("-", "")
-        self._password = None
+        # The header is used as AAD and is decoded once as it never changes
+        self._header_bytes = bytes.fromhex(self.header)
 
-    @property
+    @functools.cached_property
     def password(self):
         """The plaintext password of the entry.
 
         Returns:
-            password (text): The plaintext password of the entry.
+            password (text): The plaintext password of the entry, None if it is missing or cannot be decrypted.
 
         """
-        if self._password is None:
-            # The value object holds the ciphertext (same length as plaintext) +
-            # (authentication) tag (16 bytes) and is stored in hex
-            try:
-                ciphertext = bytearray.fromhex(self._password_value[:len(self._password_value) - 32])
-            except TypeError:
-                LOGGER.warning(f'Entry with title :{self.title} and '
-                               f'uuid :{self.uuid} does not seem to have a password.')
-                return None
-            # Now we can initialize, decrypt the ciphertext and verify the AAD.
-            # You can compare the SHA-1 output with the value stored in the db
-            cipher = AES.new(self.key, AES.MODE_GCM, nonce=self.nonce)
-            cipher.update(bytearray.fromhex(self.header))
-            self._password = cipher.decrypt(ciphertext).decode("utf-8")
-        return self._password
+        if self._ct_and_tag is None:
+            LOGGER.warning(f'Entry with title :{self.title} and '
+                           f'uuid :{self.uuid} does not seem to have a password.')
+            return None
+        # Now we can decrypt the ciphertext and verify the tag and the AAD.
+        # You can compare the SHA-1 output with the value stored in the db
+        try:
+            return _decrypt(self.key, self.nonce, self._ct_and_tag, self._header_bytes).decode("utf-8")
+        except (InvalidTag, ValueError):
+            LOGGER.warning(f'Entry with title :{self.title} and '
+                           f'uuid :{self.uuid} has a password that cannot be decrypted.')
+            return None
 
     @property
     def totp_seed(self):
@@ -24,6 +24,9 @@ readme = open('README.rst').read()
 history = open('HISTORY.rst').read().replace('.. :changelog:', '')
 version = open('.VERSION').read()
 
+# Optional dependencies that speed up the key derivation and the decryption of the entries
+extras_requirements = {'fast': ['cryptography>=3.1']}
+
 
 setup(
     name='''enpassreaderlib''',
@@ -38,6 +41,7 @@ setup(
                  '''enpassreaderlib'''},
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extras_requirements,
     license='MIT',
     zip_safe=False,
     keywords='''enpassreaderlib enpass 6''',
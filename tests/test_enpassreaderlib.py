@@ -33,7 +33,20 @@ Tests for `enpassreaderlib` module.
 
 """
 
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, mock, skipIf
+
 from betamax.fixtures import unittest
+from Crypto.Cipher import AES
+
+from enpassreaderlib import EnpassDB, enpassreaderlib
+from enpassreaderlib.enpassreaderlib import Entry
+from enpassreaderlib.enpassreaderlibexceptions import EnpassDatabaseError
 
 __author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
 __docformat__ = '''google'''
@@ -63,3 +76,279 @@ class TestEnpassreaderlib(unittest.BetamaxTestCase):
         This is where you should tear down what you've setup in setUp before. This method is called after every test.
         """
         pass
+
+
+def encrypt_password(key, nonce, uuid, password):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(bytes.fromhex(uuid.replace('-', '')))
+    return cipher.encrypt_and_digest(password.encode('utf-8'))
+
+
+class TestEntry(TestCase):
+
+    def setUp(self):
+        """
+        Test set up
+
+        Builds a database row with a password encrypted the way enpass does it.
+        """
+        key, nonce, uuid = os.urandom(32), os.urandom(12), '0a1b2c3d-4e5f-6a7b-8c9d-0e1f2a3b4c5d'
+        ciphertext, tag = encrypt_password(key, nonce, uuid, 'secret')
+        self.row = {'key': key + nonce,
+                    'title': 'title',
+                    'uuid': uuid,
+                    'password_value': (ciphertext + tag).hex(),
+                    'password_value_hash': None,
+                    'totp_value': None,
+                    'totp_value_hash': None}
+        self.tampered_row = dict(self.row, password_value=(ciphertext + bytes([tag[0] ^ 1]) + tag[1:]).hex())
+
+    def test_password(self):
+        self.assertEqual(Entry(self.row).password, 'secret')
+
+    def test_missing_password(self):
+        self.assertIsNone(Entry(dict(self.row, password_value=None)).password)
+
+    def test_tampered_password(self):
+        self.assertIsNone(Entry(self.tampered_row).password)
+
+    def test_pycryptodome_fallback(self):
+        with mock.patch.object(enpassreaderlib, 'AESGCM', None):
+            self.assertEqual(Entry(self.row).password, 'secret')
+            self.assertIsNone(Entry(self.tampered_row).password)
+
+
+class MockedDatabaseTestCase(TestCase):
+
+    def setUp(self):
+        """
+        Test set up
+
+        Replaces sqlcipher with a mock and the key derivation with a cheap one so the database object can be
+        tested without an actual enpass database.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.directory.name, 'cache')
+        self.database_path = Path(self.directory.name, 'vault.enpassdb')
+        self.database_path.write_bytes(os.urandom(1024))
+        patches = [mock.patch.object(enpassreaderlib, 'DERIVED_KEY_CACHE_PATH', self.cache_path),
+                   mock.patch.object(enpassreaderlib, 'sqlite'),
+                   mock.patch.object(EnpassDB, '_derive_key', autospec=True,
+                                     side_effect=lambda db, salt: hashlib.sha512(db.master_password + salt).digest())]
+        self.sqlite, self.derive_key = [patch.start() for patch in patches][1:]
+        self.sqlite.DatabaseError = sqlite3.DatabaseError
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        """
+        Test tear down
+
+        Removes the temporary cache directory and database.
+        """
+        self.directory.cleanup()
+
+
+class TestKeyFile(MockedDatabaseTestCase):
+
+    def _get_master_password(self, content):
+        keyfile = Path(self.directory.name, 'vault.enpasskey')
+        keyfile.write_bytes(content)
+        return EnpassDB(str(self.database_path), 'password', keyfile=str(keyfile)).master_password
+
+    def test_key_file(self):
+        key = os.urandom(32)
+        self.assertEqual(self._get_master_password(b'<key>' + key.hex().encode() + b'</key>'), b'password' + key)
+
+    def test_key_file_with_whitespace(self):
+        key = os.urandom(32)
+        content = b'<?xml version="1.0" encoding="UTF-8"?>\n<key>\n  ' + key.hex().upper().encode() + b'\r\n</key>\n'
+        self.assertEqual(self._get_master_password(content), b'password' + key)
+
+    def test_invalid_key_file(self):
+        for content in (b'', b'garbage', b'<key></key>', b'<key>abc</key>', b'<key>zz</key>'):
+            with self.assertRaises(EnpassDatabaseError):
+                self._get_master_password(content)
+
+
+class TestDerivedKeyCache(MockedDatabaseTestCase):
+
+    def _get_database(self, password='password', pbkdf2_rounds=1000):
+        return EnpassDB(str(self.database_path), password, pbkdf2_rounds=pbkdf2_rounds, cache_derived_key=True)
+
+    def _get_cache_files(self):
+        return list(self.cache_path.glob('*.bin'))
+
+    @staticmethod
+    def _age(path):
+        old = time.time() - enpassreaderlib.DERIVED_KEY_CACHE_TTL - 1
+        os.utime(path, (old, old))
+
+    def test_cache_miss_then_hit(self):
+        cipher_key = self._get_database().cipher_key
+        self.assertEqual(len(self._get_cache_files()), 1)
+        self.assertEqual(self._get_database().cipher_key, cipher_key)
+        self.assertEqual(self.derive_key.call_count, 1)
+
+    def test_cache_with_pycryptodome(self):
+        with mock.patch.object(enpassreaderlib, 'AESGCM', None):
+            cipher_key = self._get_database().cipher_key
+            self.assertEqual(self._get_database().cipher_key, cipher_key)
+        self.assertEqual(self._get_database().cipher_key, cipher_key)
+        self.assertEqual(self.derive_key.call_count, 1)
+
+    def test_different_password_misses(self):
+        cipher_key = self._get_database().cipher_key
+        self.assertNotEqual(self._get_database('other').cipher_key, cipher_key)
+        self.assertEqual(self.derive_key.call_count, 2)
+        self.assertEqual(len(self._get_cache_files()), 2)
+
+    def test_rounds_and_password_do_not_run_into_each_other(self):
+        cipher_key = self._get_database('pw', pbkdf2_rounds=10000).cipher_key
+        self.assertNotEqual(self._get_database('0pw', pbkdf2_rounds=1000).cipher_key, cipher_key)
+        self.assertEqual(self.derive_key.call_count, 2)
+        self.assertEqual(len(self._get_cache_files()), 2)
+
+    def test_no_home_directory_disables_cache(self):
+        with mock.patch.object(enpassreaderlib, 'DERIVED_KEY_CACHE_PATH', None), \
+                mock.patch.object(Path, 'home', side_effect=RuntimeError):
+            self.assertEqual(self._get_database().cipher_key, self._get_database().cipher_key)
+        self.assertEqual(self.derive_key.call_count, 2)
+        self.assertFalse(self.cache_path.exists())
+
+    def test_disabled_by_default(self):
+        EnpassDB(str(self.database_path), 'password', pbkdf2_rounds=1000)
+        self.assertFalse(self.cache_path.exists())
+
+    def test_failed_authentication_is_not_cached(self):
+        self.sqlite.connect.return_value.cursor.return_value.execute.side_effect = sqlite3.DatabaseError
+        with self.assertRaises(EnpassDatabaseError):
+            self._get_database('wrong')
+        self.assertEqual(self._get_cache_files(), [])
+
+    def test_expired_key_is_derived_again(self):
+        self._get_database()
+        self._age(self._get_cache_files()[0])
+        self._get_database()
+        self.assertEqual(self.derive_key.call_count, 2)
+        self.assertEqual(len(self._get_cache_files()), 1)
+
+    def test_expired_keys_are_swept_on_write(self):
+        self._get_database()
+        expired, = self._get_cache_files()
+        self._age(expired)
+        self._get_database('other')
+        self.assertNotIn(expired, self._get_cache_files())
+        self.assertEqual(len(self._get_cache_files()), 1)
+
+    def test_expired_secret_is_rotated(self):
+        self._get_database()
+        secret_file = Path(self.cache_path, enpassreaderlib.DERIVED_KEY_CACHE_LOCAL_KEY_FILENAME)
+        secret = secret_file.read_bytes()
+        cache_files = self._get_cache_files()
+        self._age(secret_file)
+        self._get_database()
+        self.assertEqual(self.derive_key.call_count, 2)
+        self.assertNotEqual(secret_file.read_bytes(), secret)
+        # The name of the cached key depends on the secret and not only on the password
+        self.assertNotEqual(self._get_cache_files(), cache_files)
+        self.assertEqual(len(self._get_cache_files()), 1)
+
+    def test_invalid_cache_files_are_ignored(self):
+        database = self._get_database()
+        salt = self.database_path.read_bytes()[:16]
+        cache_file, = self._get_cache_files()
+        cached_value = cache_file.read_bytes()
+        tampered_value = cached_value[:-1] + bytes([cached_value[-1] ^ 1])
+        for value in (tampered_value, b'garbage', b''):
+            cache_file.write_bytes(value)
+            self.assertIsNone(database._get_cached_key(salt))  # pylint: disable=protected-access
+        self.assertEqual(self._get_database().cipher_key, database.cipher_key)
+        self.assertEqual(self.derive_key.call_count, 2)
+
+    @skipIf(os.name == 'nt', 'Posix permissions are not available on windows')
+    def test_cache_permissions(self):
+        self._get_database()
+        self.assertEqual(self.cache_path.stat().st_mode & 0o777, 0o700)
+        for path in self.cache_path.iterdir():
+            self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+
+
+class TestQueries(TestCase):
+
+    def setUp(self):
+        """
+        Test set up
+
+        Builds a plain sqlite database with the enpass schema parts that are queried, sqlcipher is replaced with
+        sqlite so the actual queries run against it unchanged.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        database_path = Path(self.directory.name, 'vault.enpassdb')
+        connection = sqlite3.connect(database_path)
+        connection.executescript('CREATE TABLE Identity (version INTEGER);'
+                                 'INSERT INTO Identity VALUES (6);'
+                                 'CREATE TABLE item (uuid TEXT, title TEXT, key BLOB);'
+                                 'CREATE TABLE itemfield (item_uuid TEXT, type TEXT, value TEXT, hash TEXT);')
+        items = [('Github', 'github password', False),
+                 ('GitLab', 'gitlab password', False),
+                 ('My "quoted" title', 'quoted password', False),
+                 ('Deleted', 'deleted password', True)]
+        for index, (title, password, deleted) in enumerate(items):
+            uuid = f'{index:08x}-4e5f-6a7b-8c9d-0e1f2a3b4c5d'
+            key, nonce = os.urandom(32), os.urandom(12)
+            ciphertext, tag = encrypt_password(key, nonce, uuid, password)
+            # Deleted items keep only the key without the nonce
+            connection.execute('INSERT INTO item VALUES (?, ?, ?)', (uuid, title, key if deleted else key + nonce))
+            connection.execute('INSERT INTO itemfield VALUES (?, ?, ?, ?)',
+                               (uuid, 'password', (ciphertext + tag).hex(), None))
+        connection.commit()
+        connection.close()
+        patches = [mock.patch.object(enpassreaderlib, 'sqlite', sqlite3),
+                   mock.patch.object(EnpassDB, '_derive_key', return_value=os.urandom(64))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.database = EnpassDB(str(database_path), 'password')
+
+    def tearDown(self):
+        """
+        Test tear down
+
+        Closes the database and removes the temporary directory.
+        """
+        self.database._connection.close()  # pylint: disable=protected-access
+        self.directory.cleanup()
+
+    def test_deleted_items_are_filtered(self):
+        self.assertEqual(sorted(entry.title for entry in self.database.entries),
+                         ['GitLab', 'Github', 'My "quoted" title'])
+        self.assertIsNone(self.database.get_entry('deleted'))
+        self.assertEqual(self.database.search_entries('deleted'), [])
+
+    def test_get_entry(self):
+        self.assertEqual(self.database.get_entry('GITHUB').password, 'github password')
+        self.assertIsNone(self.database.get_entry('missing'))
+
+    def test_quoted_title(self):
+        self.assertEqual(self.database.get_entry('my "quoted" title').password, 'quoted password')
+        self.assertEqual([entry.title for entry in self.database.search_entries('"quoted"')], ['My "quoted" title'])
+
+    def test_names_are_not_interpolated(self):
+        self.assertIsNone(self.database.get_entry('x" OR "1" = "1'))
+        self.assertEqual(self.database.search_entries('%" OR "1" = "1'), [])
+
+    def test_search_entries(self):
+        self.assertEqual(sorted(entry.password for entry in self.database.search_entries('git')),
+                         ['github password', 'gitlab password'])
+
+    def test_iter_entries_alongside_get_entry(self):
+        titles = []
+        for entry in self.database.iter_entries():
+            titles.append(entry.title)
+            self.assertEqual(self.database.get_entry(entry.title).title, entry.title)
+        self.assertEqual(sorted(titles), ['GitLab', 'Github', 'My "quoted" title'])
+
+    def test_decrypt_all(self):
+        self.assertEqual(sorted(entry.password for entry in self.database.decrypt_all()),
+                         ['github password', 'gitlab password', 'quoted password'])